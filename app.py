@@ -1,28 +1,162 @@
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, request, send_from_directory
 from flask_cors import CORS
 import sqlite3
 import os
 import re
+import string
 import logging
 import json
+import functools
+import threading
 import unicodedata
+import orjson
+import pandas as pd
+from collections import defaultdict
 
 # 設置日誌
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__, static_folder='../frontend')
 CORS(app)
 
 # 資料庫路徑
-DB_PATH = os.path.join(os.path.dirname(__file__), 'crop_usage.db')
+DB_PATH = '/data/crop_usage.db'
+
+# 關鍵字類型與對應欄位，順序即關鍵字同時屬於多個類型時的優先順序
+KEYWORD_CATEGORIES = (
+    ('crops', '作物名稱'),
+    ('pests', '病蟲害名稱'),
+    ('chems', '中文名稱'),
+    ('brands', '廠牌名稱'),
+    ('barcodes', '條碼'),
+)
+
+# 資料快取：整張 crop_usage 表（DataFrame）與關鍵字分類集合，資料庫檔案（含 WAL 檔）變動時更新
+# 更新時建立新的 dict 再整個替換，讀取中的請求不會看到新舊混雜的資料
+_CATEGORY_CACHE = {}
+_CATEGORY_LOCK = threading.Lock()
+
+# 關鍵字分隔符號（半形/全形逗號、空白）
+KEYWORD_SPLIT_RE = re.compile(r'[,，\s]+')
+
+# 安全採收期中的非數字字元
+NON_DIGIT_RE = re.compile(r'\D')
+
+# SQLite 的 LIKE 只對 ASCII 字母不分大小寫
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+# 關鍵字分類對應的作物+農藥/廠牌/條碼查詢類型
+CATEGORY_KEYWORD_TYPES = {
+    'chems': 'chem',
+    'brands': 'brand',
+    'barcodes': 'barcode',
+}
+
+# 作物+農藥/廠牌/條碼查詢時，關鍵字類型對應的欄位
+KEYWORD_TYPE_COLUMNS = {
+    'chem': '中文名稱',
+    'brand': '廠牌名稱',
+    'barcode': '條碼',
+}
 
 
 def get_db_connection():
-    conn = sqlite3.connect('/data/crop_usage.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    """開啟新的唯讀連線；資料庫檔案不存在時直接失敗，不會建立空檔案"""
+    return sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True)
+
+def init_db():
+    """建立正規化病蟲害名稱欄位，並切換為 WAL 模式（啟動時執行一次）"""
+    if not os.path.exists(DB_PATH):
+        logger.warning(f"找不到資料庫檔案: {DB_PATH}")
+        return
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        # 預先計算 NFKC 正規化後的病蟲害名稱，查詢時不需逐筆正規化
+        existing_columns = {row[1] for row in conn.execute('PRAGMA table_info(crop_usage)')}
+        if '病蟲害名稱_nfkc' not in existing_columns:
+            conn.execute('ALTER TABLE crop_usage ADD COLUMN 病蟲害名稱_nfkc TEXT')
+        conn.create_function('normalize_pest_name', 1, normalize_pest_name)
+        # 新增的列或 ETL 修改過病蟲害名稱的列，正規化結果與存放值不同時重新計算
+        conn.execute(
+            "UPDATE crop_usage SET 病蟲害名稱_nfkc = normalize_pest_name(病蟲害名稱) "
+            "WHERE 病蟲害名稱_nfkc IS NOT normalize_pest_name(病蟲害名稱)"
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.warning(f"初始化資料庫失敗: {str(e)}")
+    finally:
+        conn.close()
 
+def database_version():
+    """資料庫檔案與 WAL 檔的修改時間與大小；WAL 模式下寫入先進 -wal 檔，主檔修改時間不一定會變"""
+    version = []
+    for path in (DB_PATH, f'{DB_PATH}-wal'):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        # 讀取連線開啟時會建立空的 -wal 檔，空檔與不存在視為相同
+        version.append((stat.st_mtime_ns, stat.st_size) if stat and stat.st_size else None)
+    return tuple(version)
+
+def load_categories():
+    """載入整張資料表與所有類型名稱集合，資料庫檔案未更新時直接回傳快取"""
+    global _CATEGORY_CACHE
+    version = database_version()
+    cache = _CATEGORY_CACHE
+    if cache.get('version') == version:
+        return cache
+    with _CATEGORY_LOCK:
+        cache = _CATEGORY_CACHE
+        if cache.get('version') == version:
+            return cache
+        # 每次更新都開新連線、讀完即關閉，資料庫檔案被整個替換後也會讀到新檔案
+        conn = get_db_connection()
+        try:
+            cursor = conn.execute("SELECT * FROM crop_usage")
+            columns = [description[0] for description in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+        # 保留 object 型別，空值維持 None（不轉成 NaN）
+        table = pd.DataFrame(rows, columns=columns, dtype=object)
+        records = table.to_dict('records')
+        # 各關鍵字欄位的 值 -> 列位置 索引，等值查詢只需查 dict
+        positions = {
+            column: {value: indices.tolist() for value, indices in table.groupby(column, sort=False).indices.items()}
+            for _, column in KEYWORD_CATEGORIES
+        }
+        categories = {
+            'records': records,
+            'positions': positions,
+            # 病蟲害名稱的 LIKE 比對字串，供作物範圍內的 LIKE '%病蟲害%' 比對
+            'pest_text': [like_text((row['病蟲害名稱'],)) for row in records],
+            # 每列五個關鍵字欄位串成一個 LIKE 比對字串，模糊查詢每列只需比對一次
+            'search_text': [like_text(row[column] for _, column in KEYWORD_CATEGORIES) for row in records],
+        }
+        for name, column in KEYWORD_CATEGORIES:
+            categories[name] = frozenset(positions[column])
+        # 關鍵字 -> 類型；同時屬於多個類型時取 KEYWORD_CATEGORIES 中較前面的類型
+        keyword_categories = {}
+        for name, _ in reversed(KEYWORD_CATEGORIES):
+            keyword_categories.update(dict.fromkeys(categories[name], name))
+        categories['keyword_categories'] = keyword_categories
+        # 廠牌 -> 第一個中文名稱、條碼 -> (中文名稱, 廠牌名稱)，供查無資料時組顯示名稱
+        brand_chems = {}
+        barcode_names = {}
+        for row in records:
+            brand_chems.setdefault(row['廠牌名稱'], row['中文名稱'])
+            barcode_names.setdefault(row['條碼'], (row['中文名稱'], row['廠牌名稱']))
+        categories['brand_chems'] = brand_chems
+        categories['barcode_names'] = barcode_names
+        categories['version'] = version
+        _CATEGORY_CACHE = categories
+        logger.debug(f"已載入資料快取，共 {len(records)} 筆，資料庫版本: {version}")
+    return categories
+
+@functools.lru_cache(maxsize=8192)
 def normalize_pest_name(name):
     if not name:
         return ''
@@ -31,28 +165,84 @@ def normalize_pest_name(name):
     name = name.replace(' ', '').replace('\u3000', '').lower()
     return name
 
-def remove_duplicate_pesticides(pesticides):
-    """去除重複的農藥（中文名稱+劑型+含量）"""
-    unique_pesticides = {}
-    for pesticide in pesticides:
-        key = f"{pesticide['中文名稱']}__{pesticide['劑型']}__{pesticide['含量']}"
-        if key not in unique_pesticides:
-            unique_pesticides[key] = pesticide
-    return list(unique_pesticides.values())
+def split_keywords(keywords):
+    """將搜尋字串拆成關鍵字列表（單一關鍵字時不經過正規表示式）"""
+    if ',' not in keywords and '，' not in keywords and not any(c.isspace() for c in keywords):
+        return [keywords] if keywords else []
+    return [k for k in KEYWORD_SPLIT_RE.split(keywords) if k]
+
+def json_response(data, status=200):
+    """以 orjson 輸出 JSON 回應（中文不轉義，set 直接轉為 list）"""
+    return Response(orjson.dumps(data, default=list), status=status, mimetype='application/json')
+
+def pesticide_key(row):
+    """農藥的識別鍵（中文名稱+劑型+含量）"""
+    return f"{row['中文名稱']}__{row['劑型']}__{row['含量']}"
+
+def build_usage(row):
+    """由資料列建立一筆使用資訊"""
+    pest_name = row['病蟲害名稱']
+    normalized_pest_name = row.get('病蟲害名稱_nfkc')
+    if normalized_pest_name is None:
+        # 資料庫尚未建立正規化欄位（例如唯讀）時才即時計算
+        normalized_pest_name = normalize_pest_name(pest_name)
+    return {
+        '作物名稱': row['作物名稱'],
+        '病蟲害名稱': pest_name,
+        '病蟲害名稱_normalized': normalized_pest_name,
+        '安全採收期': row['安全採收期'] or '',
+        '稀釋倍數': row['稀釋倍數'] or '',
+        '每公頃使用用藥量': row['每公頃使用用藥量'] or ''
+    }
+
+def column_positions(data, column, value):
+    """等同 SQL 的 column = value，由快取的位置索引取得符合的列位置"""
+    return data['positions'][column].get(value, [])
+
+def filter_equals(data, positions, column, value):
+    """在指定列位置中保留 column = value 的列"""
+    records = data['records']
+    return [i for i in positions if records[i][column] == value]
+
+def like_text(values):
+    """將欄位值串成 LIKE 比對用字串：每個非空值前加 \\0 分隔並轉 ASCII 小寫，空值略過（NULL LIKE 任何條件皆不成立）"""
+    return ''.join('\0' + str(value).translate(ASCII_LOWER) for value in values if value is not None)
+
+def like_matcher(keyword):
+    """回傳判斷 like_text 字串是否符合 LIKE '%keyword%' 的函式（% 與 _ 為萬用字元，同 SQLite）"""
+    keyword = keyword.translate(ASCII_LOWER)
+    if '%' not in keyword and '_' not in keyword:
+        return lambda text: keyword in text
+    # 萬用字元不跨越 \0，比對限制在單一欄位值之內
+    pattern = ''.join('[^\0]*' if c == '%' else '[^\0]' if c == '_' else re.escape(c) for c in keyword)
+    return re.compile('\0[^\0]*' + pattern).search
+
+def filter_pests(data, positions, pest_keywords):
+    """在指定列位置中保留 病蟲害名稱 LIKE '%pest%'（任一病蟲害）的列"""
+    pest_text = data['pest_text']
+    matchers = [like_matcher(pest) for pest in pest_keywords]
+    return [i for i in positions if any(match(pest_text[i]) for match in matchers)]
+
+def search_positions(data, keyword):
+    """等同五個關鍵字欄位任一 LIKE '%keyword%' 的全表查詢"""
+    match = like_matcher(keyword)
+    return [i for i, text in enumerate(data['search_text']) if match(text)]
+
+def select_rows(data, positions):
+    """依列位置取出資料列，每列為 {欄位: 值}（快取共用，不可修改）"""
+    records = data['records']
+    return [records[i] for i in positions]
 
 def remove_duplicate_usages(usages):
-    """去除重複的使用資訊"""
-    unique_usages = []
+    """去除重複的使用資訊（病蟲害名稱+安全採收期+稀釋倍數+每公頃使用用藥量）"""
+    unique_usages = {}
     for usage in usages:
-        if not any(
-            u['病蟲害名稱'] == usage['病蟲害名稱'] and
-            u['安全採收期'] == usage['安全採收期'] and
-            u['稀釋倍數'] == usage['稀釋倍數'] and
-            u['每公頃使用用藥量'] == usage['每公頃使用用藥量']
-            for u in unique_usages
-        ):
-            unique_usages.append(usage)
-    return unique_usages
+        key = (usage['病蟲害名稱'], usage['安全採收期'], usage['稀釋倍數'], usage['每公頃使用用藥量'])
+        if key not in unique_usages:
+            unique_usages[key] = usage
+    return list(unique_usages.values())
+
+init_db()
 
 @app.route('/')
 def index():
@@ -69,104 +259,90 @@ def search_pesticides():
         logger.debug(f"收到搜尋請求，關鍵字: {keywords}")
 
         if not keywords:
-            return jsonify([])
+            return json_response([])
 
-        keyword_list = [k.strip() for k in re.split(r'[,，\s]+', keywords) if k.strip()]
+        keyword_list = split_keywords(keywords)
         logger.debug(f"處理後的關鍵字列表: {keyword_list}")
 
         if not keyword_list:
-            return jsonify([])
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        # 取得所有類型名稱集合
-        cursor.execute("SELECT DISTINCT 作物名稱 FROM crop_usage")
-        all_crops = set(row['作物名稱'] for row in cursor.fetchall())
-        cursor.execute("SELECT DISTINCT 病蟲害名稱 FROM crop_usage")
-        all_pests = set(row['病蟲害名稱'] for row in cursor.fetchall())
-        cursor.execute("SELECT DISTINCT 中文名稱 FROM crop_usage")
-        all_chems = set(row['中文名稱'] for row in cursor.fetchall())
-        cursor.execute("SELECT DISTINCT 廠牌名稱 FROM crop_usage")
-        all_brands = set(row['廠牌名稱'] for row in cursor.fetchall())
-        cursor.execute("SELECT DISTINCT 條碼 FROM crop_usage")
-        all_barcodes = set(row['條碼'] for row in cursor.fetchall())
-
-        # 分類
-        crop_keywords = [kw for kw in keyword_list if kw in all_crops]
-        pest_keywords = [kw for kw in keyword_list if kw in all_pests]
-        chem_keywords = [kw for kw in keyword_list if kw in all_chems]
-        brand_keywords = [kw for kw in keyword_list if kw in all_brands]
-        barcode_keywords = [kw for kw in keyword_list if kw in all_barcodes]
-        other_keywords = [kw for kw in keyword_list if kw not in (
-            all_crops | all_pests | all_chems | all_brands | all_barcodes
-        )]
+            return json_response([])
+
+        # 取得所有類型名稱集合（快取）
+        cats = load_categories()
+
+        # 分類：每個關鍵字只歸入一個類型（依 KEYWORD_CATEGORIES 的優先順序）
+        keyword_categories = cats['keyword_categories']
+        buckets = defaultdict(list)
+        for kw in keyword_list:
+            buckets[keyword_categories.get(kw, 'other')].append(kw)
+        crop_keywords = buckets['crops']
+        pest_keywords = buckets['pests']
+        chem_keywords = buckets['chems']
+        brand_keywords = buckets['brands']
+        barcode_keywords = buckets['barcodes']
+        other_keywords = buckets['other']
         mixed_keywords = chem_keywords + brand_keywords + barcode_keywords
 
         results = []
 
         # 作物 + 多個病蟲害（交集）
         if crop_keywords and len(pest_keywords) >= 2:
-            results += handle_crop_pests_intersection(cursor, crop_keywords, pest_keywords)
+            results += handle_crop_pests_intersection(cats, crop_keywords, pest_keywords)
 
         # 作物 + 單一病蟲害
         if crop_keywords and len(pest_keywords) == 1:
-            results += handle_crop_single_pest(cursor, crop_keywords, pest_keywords[0])
+            results += handle_crop_single_pest(cats, crop_keywords, pest_keywords[0])
 
         # 作物 + 農藥 / 廠牌 / 條碼（逐個查）
         if crop_keywords and mixed_keywords:
             results += handle_crop_mixed_keywords(
-                cursor, crop_keywords, mixed_keywords, all_chems, all_brands, all_barcodes
+                cats, crop_keywords, mixed_keywords, keyword_categories,
+                cats['brand_chems'], cats['barcode_names']
             )
 
         # 只有作物（無其他關鍵字）
         if crop_keywords and not (pest_keywords or mixed_keywords):
-            results += handle_crop_only(cursor, crop_keywords)
+            results += handle_crop_only(cats, crop_keywords)
 
         # 只有農藥
         if chem_keywords and not crop_keywords:
-            results += handle_chem_only(cursor, chem_keywords)
+            results += handle_chem_only(cats, chem_keywords)
 
         # 只有廠牌
         if brand_keywords and not crop_keywords:
-            results += handle_brand_only(cursor, brand_keywords)
+            results += handle_brand_only(cats, brand_keywords)
 
         # 只有條碼
         if barcode_keywords and not crop_keywords:
-            results += handle_barcode_only(cursor, barcode_keywords)
+            results += handle_barcode_only(cats, barcode_keywords)
 
         # 其他 fallback 模糊查詢（只有其他未分類詞）
         if not crop_keywords and not pest_keywords and not mixed_keywords and other_keywords:
-            results += handle_fallback_partial_match(cursor, other_keywords)
+            results += handle_fallback_partial_match(cats, other_keywords)
 
         # 排序與回傳
         results = deduplicate_and_sort_results(results, crop_keywords, pest_keywords, keyword_list)
-        conn.close()
 
-        # 組合最終結果
+        # 組合最終結果（matchSet 等 set 欄位由 json_response 轉為 list）
         final_results = results
 
-        # 將所有結果中的 matchSet 從 set 轉換為 list
-        for result in final_results:
-            if 'matchSet' in result:
-                result['matchSet'] = list(result['matchSet'])
-
-        print(f"處理請求完成，共找到 {len(final_results)} 個結果")
-        return jsonify(final_results)
+        logger.info(f"處理請求完成，共找到 {len(final_results)} 個結果")
+        return json_response(final_results)
 
     except Exception as e:
         logger.error(f"處理請求時發生錯誤: {str(e)}", exc_info=True)
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, status=500)
 
-def deduplicate_and_sort_results(results, crop_keywords, pest_keywords, keywords=None):
-    def extract_days(text):
-        if not text:
-            return float('inf')
-        try:
-            return int(re.sub(r'\D', '', text))
-        except:
-            return float('inf')
+def extract_days(text):
+    """取出安全採收期中的天數，無法解析時排在最後"""
+    if not text:
+        return float('inf')
+    try:
+        return int(NON_DIGIT_RE.sub('', text))
+    except (TypeError, ValueError):
+        return float('inf')
 
+def deduplicate_and_sort_results(results, crop_keywords, pest_keywords, keywords=None):
     # 依 has_exact_match、交集數量、安全採收期排序
     results.sort(key=lambda x: (
         -x.get('has_exact_match', False) if isinstance(x, dict) else 0,
@@ -175,18 +351,29 @@ def deduplicate_and_sort_results(results, crop_keywords, pest_keywords, keywords
     return results
 
 #1. 作物 + 多個病蟲害（交集）卡片
-def handle_crop_pests_intersection(cursor, crop_keywords, pest_keywords):
+def handle_crop_pests_intersection(data, crop_keywords, pest_keywords):
     results = []
+    records = data['records']
+    pest_text = data['pest_text']
+    matchers = [like_matcher(pest) for pest in pest_keywords]
     for crop in crop_keywords:
-        all_pesticides = set()
-        for pest in pest_keywords:
-            cursor.execute("SELECT DISTINCT 中文名稱, 劑型, 含量 FROM crop_usage WHERE 作物名稱 = ? AND 病蟲害名稱 LIKE ?", (crop, f"%{pest}%"))
-            rows = cursor.fetchall()
-            pesticides = {f"{row['中文名稱']}__{row['劑型']}__{row['含量']}" for row in rows}
-            if not all_pesticides:
-                all_pesticides = pesticides
-            else:
-                all_pesticides = all_pesticides.intersection(pesticides)
+        # 一次取出符合任一病蟲害的資料，再依病蟲害分組計算交集
+        positions = filter_pests(data, column_positions(data, '作物名稱', crop), pest_keywords)
+        matched_pests = {
+            i: [n for n, match in enumerate(matchers) if match(pest_text[i])]
+            for i in positions
+        }
+        # 依各列符合的第一個病蟲害關鍵字穩定排序，維持逐一病蟲害查詢時的卡片與使用資訊順序
+        positions.sort(key=lambda i: matched_pests[i][0])
+        pesticides_by_pest = [set() for _ in pest_keywords]
+        rows_by_key = defaultdict(list)
+        for i in positions:
+            row = records[i]
+            key = pesticide_key(row)
+            rows_by_key[key].append(row)
+            for n in matched_pests[i]:
+                pesticides_by_pest[n].add(key)
+        all_pesticides = set.intersection(*pesticides_by_pest)
         if not all_pesticides:
             results.append({
                 'no_match': True,
@@ -195,48 +382,30 @@ def handle_crop_pests_intersection(cursor, crop_keywords, pest_keywords):
                 'keyword': ', '.join(pest_keywords)
             })
         else:
-            all_rows = []
-            for pest in pest_keywords:
-                cursor.execute("SELECT * FROM crop_usage WHERE 作物名稱 = ? AND 病蟲害名稱 LIKE ?", (crop, f"%{pest}%"))
-                all_rows.extend(cursor.fetchall())
-            unique_pesticides = [
-                p for p in remove_duplicate_pesticides([{
+            # 依農藥分組後的資料直接組成卡片，只保留共同防治的農藥
+            for key, rows in rows_by_key.items():
+                if key not in all_pesticides:
+                    continue
+                row = rows[0]
+                results.append({
                     '中文名稱': row['中文名稱'],
                     '劑型': row['劑型'],
                     '含量': row['含量'],
                     '作用機制名稱': row['作用機制名稱'],
                     '作用機制備註': row['作用機制備註'],
-                    'usages': [],
+                    'usages': remove_duplicate_usages([build_usage(r) for r in rows]),
                     'has_common_pesticide': True,
                     'crop': crop,
                     'keyword': ', '.join(pest_keywords),
                     'is_crop_and_pest_search': True
-                } for row in all_rows])
-                if f"{p['中文名稱']}__{p['劑型']}__{p['含量']}" in all_pesticides
-            ]
-            for pesticide in unique_pesticides:
-                for row in all_rows:
-                    if (row['中文名稱'] == pesticide['中文名稱'] and 
-                        row['劑型'] == pesticide['劑型'] and 
-                        row['含量'] == pesticide['含量']):
-                        pesticide['usages'].append({
-                            '作物名稱': row['作物名稱'],
-                            '病蟲害名稱': row['病蟲害名稱'],
-                            '病蟲害名稱_normalized': normalize_pest_name(row['病蟲害名稱']),
-                            '安全採收期': row['安全採收期'] or '',
-                            '稀釋倍數': row['稀釋倍數'] or '',
-                            '每公頃使用用藥量': row['每公頃使用用藥量'] or ''
-                        })
-                pesticide['usages'] = remove_duplicate_usages(pesticide['usages'])
-            results.extend(unique_pesticides)
+                })
     return results
 
 #2.作物+單一病害卡片
-def handle_crop_single_pest(cursor, crop_keywords, pest):
+def handle_crop_single_pest(data, crop_keywords, pest):
     results = []
     for crop in crop_keywords:
-        cursor.execute("SELECT * FROM crop_usage WHERE 作物名稱 = ? AND 病蟲害名稱 LIKE ?", (crop, f"%{pest}%"))
-        rows = cursor.fetchall()
+        rows = select_rows(data, filter_pests(data, column_positions(data, '作物名稱', crop), [pest]))
         if not rows:
             results.append({
                 'no_match': True,
@@ -247,7 +416,7 @@ def handle_crop_single_pest(cursor, crop_keywords, pest):
         else:
             pesticide_map = {}
             for row in rows:
-                key = f"{row['中文名稱']}__{row['劑型']}__{row['含量']}"
+                key = pesticide_key(row)
                 if key not in pesticide_map:
                     pesticide_map[key] = {
                         '中文名稱': row['中文名稱'],
@@ -260,58 +429,60 @@ def handle_crop_single_pest(cursor, crop_keywords, pest):
                         'keyword': pest,
                         'is_crop_and_pest_search': True
                     }
-                pesticide_map[key]['usages'].append({
-                    '作物名稱': row['作物名稱'],
-                    '病蟲害名稱': row['病蟲害名稱'],
-                    '病蟲害名稱_normalized': normalize_pest_name(row['病蟲害名稱']),
-                    '安全採收期': row['安全採收期'] or '',
-                    '稀釋倍數': row['稀釋倍數'] or '',
-                    '每公頃使用用藥量': row['每公頃使用用藥量'] or ''
-                })
+                pesticide_map[key]['usages'].append(build_usage(row))
             for pesticide in pesticide_map.values():
                 pesticide['usages'] = remove_duplicate_usages(pesticide['usages'])
             results.extend(pesticide_map.values())
     return results
 
+def fetch_crop_keyword_rows(data, queries):
+    """批次查詢多組（作物, 關鍵字, 欄位），回傳 {(作物, 關鍵字): [rows]}"""
+    rows_by_query = {}
+    for crop, kw, column in queries:
+        positions = filter_equals(data, column_positions(data, '作物名稱', crop), column, kw)
+        rows_by_query[(crop, kw)] = select_rows(data, positions)
+    return rows_by_query
+
 #3作物+中文名稱(農藥)/廠牌名稱/條碼卡片
-def handle_crop_mixed_keywords(cursor, crop_keywords, mixed_keywords, all_chems, all_brands, all_barcodes):
+def handle_crop_mixed_keywords(data, crop_keywords, mixed_keywords, keyword_categories,
+                               brand_chems, barcode_names):
     results = []
     # 先收集所有病蟲害名稱，按農藥中文名稱分組
     pest_names_by_chem = {}
+    # 迴圈內的除錯訊息只在 DEBUG 等級時才組字串
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
     
+    # 關鍵字類型沿用分類結果（每個關鍵字只屬於一個類型）
+    kw_types = {kw: CATEGORY_KEYWORD_TYPES[keyword_categories[kw]] for kw in mixed_keywords}
+
+    # 所有 作物 × 關鍵字 的查詢一次取回
+    rows_by_query = fetch_crop_keyword_rows(data, [
+        (crop, kw, KEYWORD_TYPE_COLUMNS[kw_type])
+        for crop in crop_keywords
+        for kw, kw_type in kw_types.items()
+    ])
+
     # 第一步：收集所有病蟲害名稱
     for crop in crop_keywords:
         for kw in mixed_keywords:
-            if kw in all_chems:
-                cursor.execute("SELECT * FROM crop_usage WHERE 作物名稱 = ? AND 中文名稱 = ?", (crop, kw))
-                kw_type = 'chem'
-            elif kw in all_brands:
-                cursor.execute("SELECT * FROM crop_usage WHERE 作物名稱 = ? AND 廠牌名稱 = ?", (crop, kw))
-                kw_type = 'brand'
-            elif kw in all_barcodes:
-                cursor.execute("SELECT * FROM crop_usage WHERE 作物名稱 = ? AND 條碼 = ?", (crop, kw))
-                kw_type = 'barcode'
-            else:
-                continue
-            rows = cursor.fetchall()
+            kw_type = kw_types[kw]
+            rows = rows_by_query.get((crop, kw), [])
             if not rows:
                 # 只在這裡插入特殊卡片
                 if kw_type == 'chem':
                     display_name = kw
                     error_message = f"{display_name} 無法使用於作物：{crop}"
                 elif kw_type == 'brand':
-                    cursor.execute("SELECT DISTINCT 中文名稱 FROM crop_usage WHERE 廠牌名稱 = ?", (kw,))
-                    chems = [row['中文名稱'] for row in cursor.fetchall()]
-                    if chems:
-                        display_name = f"{chems[0]}（{kw}）"
+                    chem = brand_chems.get(kw)
+                    if chem is not None:
+                        display_name = f"{chem}（{kw}）"
                     else:
                         display_name = f"（{kw}）"
                     error_message = f"{display_name} 無法使用於作物：{crop}"
                 elif kw_type == 'barcode':
-                    cursor.execute("SELECT 中文名稱, 廠牌名稱 FROM crop_usage WHERE 條碼 = ?", (kw,))
-                    row = cursor.fetchone()
-                    if row:
-                        display_name = f"{row['中文名稱']}（{row['廠牌名稱']}） 條碼：{kw}"
+                    names = barcode_names.get(kw)
+                    if names:
+                        display_name = f"{names[0]}（{names[1]}） 條碼：{kw}"
                     else:
                         display_name = f"條碼：{kw}"
                     error_message = f"{display_name} 無法使用於作物：{crop}"
@@ -333,12 +504,13 @@ def handle_crop_mixed_keywords(cursor, crop_keywords, mixed_keywords, all_chems,
                 if chem_name not in pest_names_by_chem:
                     pest_names_by_chem[chem_name] = set()
                 pest_names_by_chem[chem_name].add(row['病蟲害名稱'])
-                print(f"收集病蟲害名稱: 農藥={chem_name}, 病蟲害={row['病蟲害名稱']}")
+                if debug_enabled:
+                    logger.debug(f"收集病蟲害名稱: 農藥={chem_name}, 病蟲害={row['病蟲害名稱']}")
 
             # 下面這段是原本的資料組裝，不要動
             pesticide_map = {}
             for row in rows:
-                key = f"{row['中文名稱']}__{row['劑型']}__{row['含量']}"
+                key = pesticide_key(row)
                 if kw_type == 'brand':
                     display_name = f"{row['中文名稱']}（{row['廠牌名稱']}）"
                 elif kw_type == 'barcode':
@@ -359,68 +531,56 @@ def handle_crop_mixed_keywords(cursor, crop_keywords, mixed_keywords, all_chems,
                         'is_crop_and_pest_search': False,  # 因為這是作物+農藥/廠牌/條碼的搜尋，不是作物+病蟲害
                         'query_type': f"作物+農藥" if kw_type == 'chem' else f"作物+{kw_type}"
                     }
-                pesticide_map[key]['usages'].append({
-                    '作物名稱': row['作物名稱'],
-                    '病蟲害名稱': row['病蟲害名稱'],
-                    '病蟲害名稱_normalized': normalize_pest_name(row['病蟲害名稱']),
-                    '安全採收期': row['安全採收期'] or '',
-                    '稀釋倍數': row['稀釋倍數'] or '',
-                    '每公頃使用用藥量': row['每公頃使用用藥量'] or ''
-                })
+                pesticide_map[key]['usages'].append(build_usage(row))
             for pesticide in pesticide_map.values():
                 pesticide['usages'] = remove_duplicate_usages(pesticide['usages'])
             results.extend(pesticide_map.values())
 
-    # 第二步：建立重複病蟲害名稱的字典
-    pest_markers = {}  # 用於儲存每個病蟲害的標記符號
-    marker_index = 0
-    markers = ['#', '@', '$', '%', '&', '*']  # 可用的標記符號
-
-    # 比較不同中文名稱農藥之間的病蟲害名稱
-    chem_names = list(pest_names_by_chem.keys())
-    for i in range(len(chem_names)):
-        for j in range(i + 1, len(chem_names)):
-            chem1 = chem_names[i]
-            chem2 = chem_names[j]
-            pests1 = pest_names_by_chem.get(chem1, set())
-            pests2 = pest_names_by_chem.get(chem2, set())
-
-            if not pests1 or not pests2:
+    # 第二步：找出不同中文名稱農藥之間重複的病蟲害名稱
+    # 建立反向索引：病蟲害名稱 -> 農藥、去除「葉」後的名稱 -> 農藥
+    chems_by_pest = defaultdict(set)
+    chems_by_stripped_pest = defaultdict(set)
+    for chem_name, pests in pest_names_by_chem.items():
+        for pest in pests:
+            # 空的病蟲害名稱不列入比對（'' 包含於任何名稱，會把其他農藥的病蟲害全部標為重複）
+            if not pest:
                 continue
-
-            # 找出兩個農藥之間共同的病蟲害
-            common_pests = set()
-            for pest1 in pests1:
-                for pest2 in pests2:
-                    if (
-                        pest1 == pest2 or
-                        pest1 in pest2 or
-                        pest2 in pest1 or
-                        pest1.replace('葉', '') == pest2.replace('葉', '')
-                    ):
-                        common_pests.add(pest1)
-                        common_pests.add(pest2)
-
-            # 為這組配對的病蟲害分配標記符號
-            if common_pests:
-                current_marker = markers[marker_index % len(markers)]
-                marker_index += 1
-                for pest in common_pests:
-                    if pest not in pest_markers:
-                        pest_markers[pest] = current_marker
-
-    # 第三步：標記重複的病蟲害名稱
+            chems_by_pest[pest].add(chem_name)
+            chems_by_stripped_pest[pest.replace('葉', '')].add(chem_name)
+
+    duplicate_pests = set()
+    # 名稱相同或去除「葉」後相同，且出現在兩種以上農藥
+    for pest in chems_by_pest:
+        if len(chems_by_stripped_pest[pest.replace('葉', '')]) >= 2:
+            duplicate_pests.add(pest)
+    # 名稱互相包含，且分屬不同農藥
+    # 以長度 1~3 的子字串建立索引：pest1 包含於 pest2 時，pest1 的前 3 字必為 pest2 的子字串，
+    # 因此只需與索引找到的候選名稱比對（可處理不足 3 字的名稱）
+    substring_index = defaultdict(set)
+    for pest in chems_by_pest:
+        for n in range(1, 4):
+            for i in range(len(pest) - n + 1):
+                substring_index[pest[i:i + n]].add(pest)
+    for pest1 in chems_by_pest:
+        for pest2 in substring_index[pest1[:3]]:
+            if pest2 != pest1 and pest1 in pest2 and len(chems_by_pest[pest1] | chems_by_pest[pest2]) >= 2:
+                duplicate_pests.add(pest1)
+                duplicate_pests.add(pest2)
+
+    # 第三步：標記重複的病蟲害名稱（沒有重複時整段略過）
     marked_count = 0
-    for result in results:
-        if isinstance(result, dict) and not result.get('no_match'):
-            for usage in result.get('usages', []):
-                pest_name = usage.get('病蟲害名稱', '')
-                if pest_name in duplicate_pests:
-                    usage['病蟲害名稱'] = f"#{pest_name}"
-                    marked_count += 1
-                    print(f"標記病蟲害: {pest_name} 在農藥 {result.get('raw_chem_name')} 中")
-
-    print(f"\n總共標記了 {marked_count} 個病蟲害名稱")
+    if duplicate_pests:
+        for result in results:
+            if isinstance(result, dict) and not result.get('no_match'):
+                for usage in result.get('usages', []):
+                    pest_name = usage.get('病蟲害名稱', '')
+                    if pest_name in duplicate_pests:
+                        usage['病蟲害名稱'] = f"#{pest_name}"
+                        marked_count += 1
+                        if debug_enabled:
+                            logger.debug(f"標記病蟲害: {pest_name} 在農藥 {result.get('raw_chem_name')} 中")
+
+    logger.debug(f"總共標記了 {marked_count} 個病蟲害名稱")
 
     # 只有在符合條件時才添加提示卡片：
     # 1. 是作物+中文名稱(農藥)/廠牌名稱/條碼卡片的搜尋
@@ -432,19 +592,18 @@ def handle_crop_mixed_keywords(cursor, crop_keywords, mixed_keywords, all_chems,
             'crop': crop_keywords[0] if crop_keywords else '',
             'keyword': ', '.join(mixed_keywords)
         })
-        print("無共同防治的病害，已添加提示卡片")
+        logger.debug("無共同防治的病害，已添加提示卡片")
 
     return results
 
 #4.只有作物的卡片
-def handle_crop_only(cursor, crop_keywords):
+def handle_crop_only(data, crop_keywords):
     results = []
     for crop in crop_keywords:
-        cursor.execute("SELECT * FROM crop_usage WHERE 作物名稱 = ?", (crop,))
-        rows = cursor.fetchall()
+        rows = select_rows(data, column_positions(data, '作物名稱', crop))
         pesticide_map = {}
         for row in rows:
-            key = f"{row['中文名稱']}__{row['劑型']}__{row['含量']}"
+            key = pesticide_key(row)
             if key not in pesticide_map:
                 pesticide_map[key] = {
                     '中文名稱': row['中文名稱'],
@@ -454,28 +613,20 @@ def handle_crop_only(cursor, crop_keywords):
                     '作用機制備註': row['作用機制備註'] or '',
                     'usages': []
                 }
-            pesticide_map[key]['usages'].append({
-                '作物名稱': row['作物名稱'],
-                '病蟲害名稱': row['病蟲害名稱'],
-                '病蟲害名稱_normalized': normalize_pest_name(row['病蟲害名稱']),
-                '安全採收期': row['安全採收期'] or '',
-                '稀釋倍數': row['稀釋倍數'] or '',
-                '每公頃使用用藥量': row['每公頃使用用藥量'] or ''
-            })
+            pesticide_map[key]['usages'].append(build_usage(row))
         for pesticide in pesticide_map.values():
             pesticide['usages'] = remove_duplicate_usages(pesticide['usages'])
         results.extend(pesticide_map.values())
     return results
 
 #5.中文名稱的卡片
-def handle_chem_only(cursor, chem_keywords):
+def handle_chem_only(data, chem_keywords):
     results = []
     for chem in chem_keywords:
-        cursor.execute("SELECT * FROM crop_usage WHERE 中文名稱 = ?", (chem,))
-        rows = cursor.fetchall()
+        rows = select_rows(data, column_positions(data, '中文名稱', chem))
         pesticide_map = {}
         for row in rows:
-            key = f"{row['中文名稱']}__{row['劑型']}__{row['含量']}"
+            key = pesticide_key(row)
             if key not in pesticide_map:
                 pesticide_map[key] = {
                     '中文名稱': f"{row['中文名稱']}",
@@ -487,28 +638,20 @@ def handle_chem_only(cursor, chem_keywords):
                     '作用機制備註': row['作用機制備註'] or '',
                     'usages': []
                 }
-            pesticide_map[key]['usages'].append({
-                '作物名稱': row['作物名稱'],
-                '病蟲害名稱': row['病蟲害名稱'],
-                '病蟲害名稱_normalized': normalize_pest_name(row['病蟲害名稱']),
-                '安全採收期': row['安全採收期'] or '',
-                '稀釋倍數': row['稀釋倍數'] or '',
-                '每公頃使用用藥量': row['每公頃使用用藥量'] or ''
-            })
+            pesticide_map[key]['usages'].append(build_usage(row))
         for pesticide in pesticide_map.values():
             pesticide['usages'] = remove_duplicate_usages(pesticide['usages'])
         results.extend(pesticide_map.values())
     return results
 
 #6.廠牌名稱的卡片
-def handle_brand_only(cursor, brand_keywords):
+def handle_brand_only(data, brand_keywords):
     results = []
     for brand in brand_keywords:
-        cursor.execute("SELECT * FROM crop_usage WHERE 廠牌名稱 = ?", (brand,))
-        rows = cursor.fetchall()
+        rows = select_rows(data, column_positions(data, '廠牌名稱', brand))
         pesticide_map = {}
         for row in rows:
-            key = f"{row['中文名稱']}__{row['劑型']}__{row['含量']}"
+            key = pesticide_key(row)
             if key not in pesticide_map:
                 # 標題顯示「中文名稱（廠牌名稱）」
                 pesticide_map[key] = {
@@ -519,28 +662,20 @@ def handle_brand_only(cursor, brand_keywords):
                     '作用機制備註': row['作用機制備註'] or '',
                     'usages': []
                 }
-            pesticide_map[key]['usages'].append({
-                '作物名稱': row['作物名稱'],
-                '病蟲害名稱': row['病蟲害名稱'],
-                '病蟲害名稱_normalized': normalize_pest_name(row['病蟲害名稱']),
-                '安全採收期': row['安全採收期'] or '',
-                '稀釋倍數': row['稀釋倍數'] or '',
-                '每公頃使用用藥量': row['每公頃使用用藥量'] or ''
-            })
+            pesticide_map[key]['usages'].append(build_usage(row))
         for pesticide in pesticide_map.values():
             pesticide['usages'] = remove_duplicate_usages(pesticide['usages'])
         results.extend(pesticide_map.values())
     return results
 
 #7.條碼的卡片
-def handle_barcode_only(cursor, barcode_keywords):
+def handle_barcode_only(data, barcode_keywords):
     results = []
     for barcode in barcode_keywords:
-        cursor.execute("SELECT * FROM crop_usage WHERE 條碼 = ?", (barcode,))
-        rows = cursor.fetchall()
+        rows = select_rows(data, column_positions(data, '條碼', barcode))
         pesticide_map = {}
         for row in rows:
-            key = f"{row['中文名稱']}__{row['劑型']}__{row['含量']}"
+            key = pesticide_key(row)
             if key not in pesticide_map:
                 # 標題顯示「中文名稱（廠牌名稱） 條碼：xxxx」
                 pesticide_map[key] = {
@@ -551,31 +686,20 @@ def handle_barcode_only(cursor, barcode_keywords):
                     '作用機制備註': row['作用機制備註'] or '',
                     'usages': []
                 }
-            pesticide_map[key]['usages'].append({
-                '作物名稱': row['作物名稱'],
-                '病蟲害名稱': row['病蟲害名稱'],
-                '病蟲害名稱_normalized': normalize_pest_name(row['病蟲害名稱']),
-                '安全採收期': row['安全採收期'] or '',
-                '稀釋倍數': row['稀釋倍數'] or '',
-                '每公頃使用用藥量': row['每公頃使用用藥量'] or ''
-            })
+            pesticide_map[key]['usages'].append(build_usage(row))
         for pesticide in pesticide_map.values():
             pesticide['usages'] = remove_duplicate_usages(pesticide['usages'])
         results.extend(pesticide_map.values())
     return results
 
 #8.其他模糊查詢的卡片
-def handle_fallback_partial_match(cursor, other_keywords):
+def handle_fallback_partial_match(data, other_keywords):
     results = []
     for kw in other_keywords:
-        cursor.execute(
-            "SELECT * FROM crop_usage WHERE 作物名稱 LIKE ? OR 病蟲害名稱 LIKE ? OR 中文名稱 LIKE ? OR 廠牌名稱 LIKE ? OR 條碼 LIKE ?",
-            tuple([f"%{kw}%"] * 5)
-        )
-        rows = cursor.fetchall()
+        rows = select_rows(data, search_positions(data, kw))
         pesticide_map = {}
         for row in rows:
-            key = f"{row['中文名稱']}__{row['劑型']}__{row['含量']}"
+            key = pesticide_key(row)
             if key not in pesticide_map:
                 pesticide_map[key] = {
                     '中文名稱': row['中文名稱'],
@@ -585,14 +709,7 @@ def handle_fallback_partial_match(cursor, other_keywords):
                     '作用機制備註': row['作用機制備註'] or '',
                     'usages': []
                 }
-            pesticide_map[key]['usages'].append({
-                '作物名稱': row['作物名稱'],
-                '病蟲害名稱': row['病蟲害名稱'],
-                '病蟲害名稱_normalized': normalize_pest_name(row['病蟲害名稱']),
-                '安全採收期': row['安全採收期'] or '',
-                '稀釋倍數': row['稀釋倍數'] or '',
-                '每公頃使用用藥量': row['每公頃使用用藥量'] or ''
-            })
+            pesticide_map[key]['usages'].append(build_usage(row))
         for pesticide in pesticide_map.values():
             pesticide['usages'] = remove_duplicate_usages(pesticide['usages'])
         results.extend(pesticide_map.values())
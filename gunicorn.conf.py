@@ -0,0 +1,11 @@
+# gunicorn 設定，啟動方式：gunicorn -c gunicorn.conf.py app:app
+# 查詢皆為 SQLite 唯讀（WAL 模式可同時讀取），以多 worker 搭配多執行緒處理並行請求
+import os
+
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_class = 'gthread'
+
+# 由主程序先載入 app，init_db()（新增欄位、回填、建立索引）只執行一次，
+# 不會由各 worker 同時對資料庫寫入；資料庫連線在請求時才建立，fork 後各自開啟
+preload_app = True